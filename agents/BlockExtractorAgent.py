@@ -17,6 +17,7 @@ from langchain_core.prompts import (
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.messages import ToolMessage, HumanMessage
 from tools.JavaScriptRunner import run_js_on_block_only_schema
+from tools import profiling
 from langchain.output_parsers import PydanticOutputParser
 from query_api_docs.examples import hardcoded_block_extractor_js
 
@@ -227,7 +228,10 @@ class BlockExtractorAgent:
                 id=tool_call["id"],
             )
             print(f'Calling tool: {tool_call["function"]["name"]}')
-            response = self.tool_executor.invoke(action)
+            with profiling.profiled_call(action.tool) as profile:
+                response = self.tool_executor.invoke(action)
+            if profile is not None:
+                print(f"Profile of {action.tool}: {json.dumps(profile)}")
             function_message = ToolMessage(
                 content=str(response), name=action.tool, tool_call_id=tool_call["id"]
             )
@@ -245,6 +249,9 @@ class BlockExtractorAgent:
             ):
                 if function_message.content.startswith("Javascript code is incorrect"):
                     error = function_message.content
+                elif function_message.content.startswith("Block height"):
+                    # skipped block heights say nothing about the code, let the model pick others
+                    pass
                 else:
                     entity_schema = function_message.content
                 js_parse_args = tool_call["function"]["arguments"]
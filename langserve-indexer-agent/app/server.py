@@ -4,9 +4,9 @@ sys.path.append("..")
 from fastapi import FastAPI, Request, HTTPException, responses
 from langserve import add_routes
 from dotenv import load_dotenv
-from langchain_core.runnables import chain, Runnable
+from langchain_core.runnables import chain, Runnable, RunnableGenerator
 from langchain_core.messages import HumanMessage, BaseMessage
-from typing import List, Dict, Any, Optional, Sequence
+from typing import List, Dict, Any, Iterator, Optional, Sequence
 from pydantic import BaseModel
 import asyncio
 import logging
@@ -28,6 +28,8 @@ os.environ["LANGCHAIN_PROJECT"] = os.getenv("LANGCHAIN_PROJECT")
 
 # Create Langgraph
 from graph.master_graph import create_graph_no_human_review, GraphState
+from tools.JavaScriptRunner import iter_schema_of_js
+from tools.profiling import get_profile_records, get_profile_summary
 
 
 def create_graph_with_defaults():
@@ -149,6 +151,36 @@ async def code_only_runnable_adapter(input_data: GraphState):
 
 add_routes(app, RunnableLambda(code_only_runnable_adapter), path="/code_only")
 
+
+###### Schema Inference Section ######
+class InferSchemaInput(BaseModel):
+    receiver: str
+    js: str
+    from_days_ago: int = 5
+    limit: int = 10
+    block_heights: List[int] = []
+
+
+# Streams the merged schema, the blocks processed and the error of every block as they come
+def infer_schema_stream(inputs: Iterator[Any]) -> Iterator[dict]:
+    for input_data in inputs:
+        if isinstance(input_data, BaseModel):
+            input_data = input_data.dict()
+        yield from iter_schema_of_js(**input_data)
+
+
+add_routes(
+    app,
+    RunnableGenerator(infer_schema_stream).with_types(input_type=InferSchemaInput),
+    path="/infer-schema",
+)
+
+
+# Stage timings of Javascript runs and schema inference, recorded when JS_PROFILING is on
+@app.get("/profile")
+async def profile():
+    return {"summary": get_profile_summary(), "records": get_profile_records()}
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,32 +1,62 @@
 import base64
 
-import requests
 import javascript
 import os.path
 import os
-from pathlib import Path
 import json
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import StructuredTool, tool
-from typing import Union, Any
+from typing import Iterator, Union, Any
 
 from tools.bitmap_indexer_client import get_block_heights
+# fetch_block is imported from here by the notebooks
+from tools.block_fetcher import (
+    fetch_block,
+    load_block,
+    load_block_with_size,
+    load_projected_block,
+    load_projected_block_with_size,
+    prefetch_blocks,
+)
+from tools.block_projection import BLOCK_PROJECTION
+from tools.block_store import BlockNotFoundError
+from tools.js_result_cache import get_js_result_cache
+from tools.js_worker_pool import block_key, get_js_worker_pool, js_source_hash, normalize_js
+from tools.lru_cache import SizedLRUCache
+from tools import profiling
 from utils import generate_schema, flatten
 from genson import SchemaBuilder
 
 
-def fetch_block(height: int) -> str:
-    Path(".blockcache").mkdir(exist_ok=True)
-    filename = f".blockcache/{height}.json"
-    if os.path.isfile(filename):
-        with open(filename, "r") as f:
-            return f.read()
-    streamer_message = requests.get(
-        f"https://70jshyr5cb.execute-api.eu-central-1.amazonaws.com/block/{height}"
-    )
-    with open(filename, "w") as f:
-        f.write(streamer_message.text)
-    return streamer_message.text
+DEEP_FREEZE_SCRIPT = os.path.join(os.path.dirname(__file__), "deep_freeze.js")
+# Frozen StreamerMessages sent to the in-process bridge (JS_WORKER_POOL_SIZE=0) by block height,
+# or by (height, receiver) for projected blocks, sized by their JSON
+parsed_blocks = SizedLRUCache(
+    int(os.getenv("PARSED_BLOCK_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+)
+
+
+def get_parsed_block(primitives, height: int, receiver: str = None):
+    """
+    Returns a new primitives.Block for the height, built on the StreamerMessage that previous
+    calls already sent over the bridge. Cached messages are frozen, see deep_freeze.js, and blocks
+    are never reused, so code that changes the block data does not change it for later calls.
+    With a receiver the block is built from its projection to that receiver.
+    """
+    key = int(height) if receiver is None else (int(height), receiver)
+    message = parsed_blocks.get(key)
+    streamer_message = None
+    if message is None:
+        # loading records its own fetch, disk_read and json_loads stages
+        if receiver is None:
+            streamer_message, size = load_block_with_size(height)
+        else:
+            streamer_message, size = load_projected_block_with_size(height, receiver)
+    with profiling.stage("parse_block"):
+        if message is None:
+            message = javascript.require(DEEP_FREEZE_SCRIPT).deepFreeze(streamer_message)
+            parsed_blocks.put(key, message, size)
+        return primitives.Block.fromStreamerMessage(message)
 
 
 class TestJavascriptOnBlock(BaseModel):
@@ -34,23 +64,111 @@ class TestJavascriptOnBlock(BaseModel):
     js: str = Field(..., title="Javascript code to run that starts with 'return '")
 
 
-def run_js_on_block(block_height: int, js: str) -> Union[Any, Exception]:
-    streamer_message = fetch_block(block_height)
+def run_js_on_block(
+    block_height: int, js: str, receiver: str = None
+) -> Union[Any, Exception]:
+    return run_js_on_blocks([block_height], js, receiver)[0]
+
+
+def run_js_on_block_in_process(
+    block_height: int, js: str, receiver: str = None
+) -> Union[Any, Exception]:
     primitives = javascript.require(
         os.path.join(os.path.dirname(__file__), "../node_modules/@near-lake/primitives")
     )
     try:
-        block = primitives.Block.fromStreamerMessage(json.loads(streamer_message))
-        result = javascript.eval_js(js)
-        if hasattr(result, "valueOf"):
-            result = result.valueOf()
+        block = get_parsed_block(primitives, block_height, receiver)
+        fn = get_compiled_function(js)
+        with profiling.stage("js_eval"):
+            result = fn(block)
+        with profiling.stage("result_decode"):
+            result = json.loads(result)
     except Exception as e:
         return e
     return result
 
 
+# Javascript functions of the in-process bridge compiled from the extraction code, by its hash
+compiled_functions = SizedLRUCache(int(os.getenv("COMPILED_FUNCTION_CACHE_SIZE", "256")))
+
+
+def get_compiled_function(js: str):
+    """
+    Returns a Javascript function of `block` that runs the code as an async function, like
+    eval_js does, and returns its awaited result as one JSON string, so the result crosses the
+    bridge in a single message instead of a proxy whose every attribute access is a round trip.
+    The bridge awaits the returned promise. BigInts are serialized as strings like in the worker
+    pool. Code is compiled once per normalized source, see js_source_hash.
+    """
+    js_hash = js_source_hash(js)
+    fn = compiled_functions.get(js_hash)
+    if fn is None:
+        js = normalize_js(js)
+        if len(js.split("\n")) == 1 and "return " not in js:
+            # a single expression is returned, like eval_js does
+            js = "return " + js
+        with profiling.stage("compile"):
+            fn = javascript.globalThis.Function(
+                "block",
+                f"""return (async () => {{
+{js}
+}})().then((result) =>
+  JSON.stringify(result === undefined ? null : result, (key, value) =>
+    typeof value === "bigint" ? value.toString() : value
+  )
+);""",
+            )
+        compiled_functions.put(js_hash, fn, 1)
+    return fn
+
+
+def run_js_on_blocks(
+    block_heights: [int], js: str, receiver: str = None
+) -> [Union[Any, Exception]]:
+    """
+    Runs the javascript code on every block height and returns the results in the same order,
+    with the exception in place of the result for blocks where it failed.
+    Results of the same code on the same blocks are reused from the result cache, the other
+    blocks are downloaded concurrently before they run.
+    With the worker pool the blocks are evaluated in batches, one call per batch, that are spread
+    over the workers and run in parallel.
+    """
+    with profiling.profiled_call("run_js_on_blocks", blocks=len(block_heights)):
+        return _run_js_on_blocks(block_heights, js, receiver)
+
+
+def _run_js_on_blocks(block_heights: [int], js: str, receiver: str = None) -> list:
+    js_result_cache = get_js_result_cache()
+    keys = [block_key(height, receiver) for height in block_heights]
+    cached = {}
+    if js_result_cache is not None and keys:
+        js_hash = js_source_hash(js)
+        with profiling.stage("result_cache"):
+            cached = js_result_cache.get_many(js_hash, keys)
+    to_run = list(dict.fromkeys(h for h, k in zip(block_heights, keys) if k not in cached))
+    if to_run:
+        # only blocks without a cached result are downloaded
+        prefetch_blocks(to_run)
+        js_worker_pool = get_js_worker_pool()
+        if js_worker_pool is None:
+            results = [run_js_on_block_in_process(h, js, receiver) for h in to_run]
+        else:
+            try:
+                results = js_worker_pool.run_on_blocks(to_run, js, receiver)
+            except Exception as e:
+                results = [e] * len(to_run)
+        fresh = {block_key(h, receiver): r for h, r in zip(to_run, results)}
+        if js_result_cache is not None:
+            with profiling.stage("result_cache"):
+                js_result_cache.put_many(js_hash, fresh)
+        cached.update(fresh)
+    return [cached[key] for key in keys]
+
+
 def run_js_on_block_only_schema(block_height: int, js: str) -> str:
     json_res = run_js_on_block(block_height, js)
+    if isinstance(json_res, BlockNotFoundError):
+        return f"{json_res}, NEAR skipped it. Use another block height."
     if isinstance(json_res, Exception):
         return f"Javascript code is incorrect, here is the exception: {json_res}"
     return generate_schema(json_res)
@@ -58,31 +176,156 @@ def run_js_on_block_only_schema(block_height: int, js: str) -> str:
 
 def run_js_on_blocks_only_schema(block_heights: [int], js: str) -> str:
     schema_builder = SchemaBuilder(schema_uri=None)
-    results = [run_js_on_block(height, js) for height in block_heights]
+    results = run_js_on_blocks(block_heights, js)
     for s in results:
+        if isinstance(s, BlockNotFoundError):
+            continue
         schema_builder.add_object(s)
     return schema_builder.to_json(indent=2)
 
 
+# Schema inference stops once the merged schema has not changed for this many blocks in a row,
+# 0 runs the code on every block
+SCHEMA_CONVERGENCE_BLOCKS = int(os.getenv("SCHEMA_CONVERGENCE_BLOCKS", "3"))
+
+
+class SchemaInferenceStats(BaseModel):
+    block_heights: int = Field(..., title="Number of sampled block heights")
+    evaluated: int = Field(..., title="Number of blocks the code was run on")
+    skipped: int = Field(0, title="Number of evaluated heights that NEAR skipped")
+    converged: bool = Field(False, title="Whether inference stopped early on a stable schema")
+
+
 def infer_schema_of_js(
     receiver: str, js: str, from_days_ago=5, limit=10, block_heights=[]
 ) -> str:
+    schema, stats = infer_schema_of_js_with_stats(
+        receiver, js, from_days_ago, limit, block_heights
+    )
+    print(
+        f"Inferred schema on {stats.evaluated} of {stats.block_heights} blocks"
+        + (", converged" if stats.converged else "")
+    )
+    return schema
+
+
+def infer_schema_of_js_with_stats(
+    receiver: str,
+    js: str,
+    from_days_ago=5,
+    limit=10,
+    block_heights=[],
+    convergence_blocks: int = None,
+) -> (str, SchemaInferenceStats):
+    """
+    Infers the schema like infer_schema_of_js and also returns how many blocks were evaluated.
+    """
+    with profiling.profiled_call("infer_schema_of_js", receiver=receiver):
+        return _infer_schema_of_js_with_stats(
+            receiver, js, from_days_ago, limit, block_heights, convergence_blocks
+        )
+
+
+def _infer_schema_of_js_with_stats(
+    receiver, js, from_days_ago, limit, block_heights, convergence_blocks
+) -> (str, SchemaInferenceStats):
+    if len(block_heights) == 0:
+        with profiling.stage("block_heights"):
+            block_heights = get_block_heights(receiver, from_days_ago, limit).tolist()
+    stats = SchemaInferenceStats(block_heights=len(block_heights), evaluated=0)
+    if len(block_heights) == 0:
+        return (
+            f"No block heights found for receiver {receiver} in the last {from_days_ago} days. Use another receiver or more days.",
+            stats,
+        )
+    update = None
+    for update in iter_schema_of_js(
+        receiver,
+        js,
+        from_days_ago,
+        limit,
+        block_heights=block_heights,
+        convergence_blocks=convergence_blocks,
+    ):
+        stats = SchemaInferenceStats(**update)
+        if update["error"] is not None and not update["skipped_block"]:
+            return (
+                f"Javascript code is incorrect on block height {update['block_height']}, here is the exception: {update['error']}",
+                stats,
+            )
+    if update is None or update["schema"] is None:
+        return (
+            f"Block heights {list(block_heights)} do not exist, NEAR skipped them. Use other block heights.",
+            stats,
+        )
+    return update["schema"], stats
+
+
+def iter_schema_of_js(
+    receiver: str,
+    js: str,
+    from_days_ago=5,
+    limit=10,
+    block_heights=[],
+    convergence_blocks: int = None,
+) -> Iterator[dict]:
+    """
+    Infers the schema like infer_schema_of_js, yielding a partial result after every block:
+    the block height, how many blocks were processed, the merged schema so far (None until a
+    block returned something), the error of the block if any, and the SchemaInferenceStats
+    counters.
+    Skipped block heights are yielded with skipped_block set and inference goes on, an error
+    of the code is yielded last.
+    Blocks are evaluated in chunks just big enough to see convergence_blocks (default
+    SCHEMA_CONVERGENCE_BLOCKS) unchanged schemas in a row, and the rest are not run once they are.
+    """
     if len(block_heights) == 0:
-        block_heights = get_block_heights(receiver, from_days_ago, limit)
+        block_heights = get_block_heights(receiver, from_days_ago, limit).tolist()
+    if convergence_blocks is None:
+        convergence_blocks = SCHEMA_CONVERGENCE_BLOCKS
+    block_heights = list(block_heights)
+    stats = SchemaInferenceStats(block_heights=len(block_heights), evaluated=0)
     schema_builder = SchemaBuilder(schema_uri=None)
     cur_schema = None
-    for height in block_heights:
-        # print(f"Inferring schema for {js} on block height {height}")
-        js_res = run_js_on_block(height, js)
-        if isinstance(js_res, Exception):
-            return f"Javascript code is incorrect on block height {height}, here is the exception: {js_res}"
-        schema_builder.add_object(js_res)
-        new_schema = schema_builder.to_json(indent=2)
-        if cur_schema != new_schema:
-            cur_schema = new_schema
-        # else:
-        #     return generate_schema(cur_schema)
-    return cur_schema
+    unchanged = 0
+    processed = 0
+    while stats.evaluated < len(block_heights) and not stats.converged:
+        if convergence_blocks > 0:
+            chunk_size = convergence_blocks - unchanged + (1 if cur_schema is None else 0)
+        else:
+            chunk_size = len(block_heights)
+        chunk = block_heights[stats.evaluated : stats.evaluated + chunk_size]
+        stats.evaluated += len(chunk)
+        results = run_js_on_blocks(
+            chunk, js, receiver if BLOCK_PROJECTION and receiver else None
+        )
+        for height, js_res in zip(chunk, results):
+            # print(f"Inferring schema for {js} on block height {height}")
+            processed += 1
+            update = {
+                "block_height": height,
+                "processed": processed,
+                "error": None,
+                "skipped_block": False,
+            }
+            if isinstance(js_res, BlockNotFoundError):
+                stats.skipped += 1
+                update.update(error=str(js_res), skipped_block=True)
+            elif isinstance(js_res, Exception):
+                yield {**update, "error": str(js_res), "schema": cur_schema, **stats.dict()}
+                return
+            else:
+                with profiling.stage("genson_merge"):
+                    schema_builder.add_object(js_res)
+                    new_schema = schema_builder.to_json(indent=2)
+                if cur_schema != new_schema:
+                    cur_schema = new_schema
+                    unchanged = 0
+                else:
+                    unchanged += 1
+                    if convergence_blocks > 0 and unchanged >= convergence_blocks:
+                        stats.converged = True
+            yield {**update, "schema": cur_schema, **stats.dict()}
 
 
 @tool
@@ -154,7 +397,7 @@ def tool_get_block_heights(receiver: str, from_days_ago: int, limit: int) -> [in
     Returns:
     [int]: List of block heights.
     """
-    return get_block_heights(receiver, from_days_ago, limit)
+    return get_block_heights(receiver, from_days_ago, limit).tolist()
 
 
 @tool
@@ -187,7 +430,7 @@ def tool_get_block_heights(receiver: str, from_days_ago: int, limit: int) -> [in
     Returns:
     [int]: List of block heights.
     """
-    return get_block_heights(receiver, from_days_ago, limit)
+    return get_block_heights(receiver, from_days_ago, limit).tolist()
 
 
 tool_js_on_block = StructuredTool.from_function(
@@ -212,9 +455,12 @@ def make_function_call(operation: dict, action: dict) -> dict:
 
 
 def get_function_calls_from_block(block_height: int, receiver: str) -> str:
-    streamer_message = fetch_block(block_height)
+    if BLOCK_PROJECTION:
+        streamer_message = load_projected_block(block_height, receiver)
+    else:
+        streamer_message = load_block(block_height)
     primitives = javascript.require("@near-lake/primitives")
-    block = primitives.Block.fromStreamerMessage(json.loads(streamer_message))
+    block = primitives.Block.fromStreamerMessage(streamer_message)
     operations = flatten(
         [
             [
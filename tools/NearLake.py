@@ -12,4 +12,4 @@ def tool_get_block_heights(receiver: str, from_days_ago: int = 7, limit=10) -> [
     :param limit: limit the number of results, default is 10
     :return: list of block heights
     """
-    return get_block_heights(receiver, from_days_ago, limit)
+    return get_block_heights(receiver, from_days_ago, limit).tolist()
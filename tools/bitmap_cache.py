@@ -0,0 +1,59 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+from tools.block_store import get_block_store, write_atomically
+
+# Keep the compressed bitmaps of closed days on disk, set to 0 to always ask the bitmap indexer
+BITMAP_CACHE = os.getenv("BITMAP_CACHE", "1").lower() in ("1", "true", "yes")
+
+
+class BitmapCache:
+    """
+    Compressed bitmap rows of the bitmap indexer by receiver and block date, one
+    {receiver}/{date}.json file per day that holds the row or null for days without actions.
+    Only closed days belong here, their rows never change once the day is over.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _day_path(self, receiver: str, block_date: str) -> Path:
+        directory = re.sub(r"[^a-z0-9._-]", "_", receiver.lower())
+        return self.path / directory / f"{block_date}.json"
+
+    def get(self, receiver: str, block_date: str) -> (bool, dict):
+        """Returns whether the day is cached and its row, None for a day without actions"""
+        try:
+            with open(self._day_path(receiver, block_date), "r") as f:
+                return True, json.load(f)
+        except FileNotFoundError:
+            return False, None
+
+    def __contains__(self, key: (str, str)) -> bool:
+        receiver, block_date = key
+        return self._day_path(receiver, block_date).exists()
+
+    def put(self, receiver: str, block_date: str, row: dict = None):
+        path = self._day_path(receiver, block_date)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomically(path, json.dumps(row).encode("utf-8"))
+
+
+_bitmap_cache = None
+_bitmap_cache_lock = threading.Lock()
+
+
+def get_bitmap_cache():
+    """Returns the bitmap cache in the block cache directory, or None when it is disabled"""
+    global _bitmap_cache
+    if not BITMAP_CACHE:
+        return None
+    if _bitmap_cache is None:
+        block_store = get_block_store()
+        with _bitmap_cache_lock:
+            if _bitmap_cache is None:
+                _bitmap_cache = BitmapCache(block_store.path / "bitmaps")
+    return _bitmap_cache
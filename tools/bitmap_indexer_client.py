@@ -1,29 +1,176 @@
-import requests
 import json
-from datetime import datetime, timedelta
+import os
+from datetime import date, datetime, timedelta, timezone
 import numpy as np
 import base64
-from utils import flatten
+from tools import http_session
+from tools.bitmap_cache import get_bitmap_cache
 
+# Bitmap rows are requested this many days at a time, so that a limit is met without
+# downloading the whole date range
+BITMAP_PAGE_DAYS = int(os.getenv("BITMAP_PAGE_DAYS", "7"))
+BLOCK_HEIGHT_ORDERS = {"oldest_first": "asc", "newest_first": "desc"}
+# A UTC day is treated as closed, and its bitmap as final, this long after it ends
+BITMAP_DAY_CLOSE_DELAY = timedelta(hours=1)
 
-def get_block_heights(receiver: str, from_days_ago: int = 7, limit=10) -> [int]:
+
+def get_block_heights(
+    receiver: str, from_days_ago: int = 7, limit=10, order: str = "oldest_first"
+) -> np.ndarray:
     """
     Get sample block heights for the given receiver from the last from_days_ago days limiting to limit number of results
     :param receiver: the name of a smart contract for the exact match (e.g. pool.near)
     :param from_days_ago: from how many days ago to start the search
-    :param limit: limit the number of results, default is 10
-    :return:
+    :param limit: limit the number of results, default is 10, None for all of them
+    :param order: "oldest_first" (default) or "newest_first", bitmaps are decoded day by day in
+        this order until limit heights are found
+    :return: block heights as a uint64 array, call .tolist() where a list of ints is needed
     """
     date_seven_days_ago = datetime.now() - timedelta(days=from_days_ago)
 
     print(
-        f"Getting block heights from bitmap indexer for receiver={receiver} from_days_ago={from_days_ago} limit={limit}"
+        f"Getting block heights from bitmap indexer for receiver={receiver} from_days_ago={from_days_ago} limit={limit} order={order}"
     )
-    block_heights = graphql_query(receiver, date_seven_days_ago.date().isoformat())
-    return block_heights[:limit]
+    block_heights = []
+    found = 0
+    for heights in iter_block_heights(
+        receiver, date_seven_days_ago.date().isoformat(), order
+    ):
+        block_heights.append(heights)
+        found += len(heights)
+        if limit is not None and found >= limit:
+            break
+    if len(block_heights) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(block_heights)[:limit]
+
+
+def graphql_query(receiver: str, starting_block_date: str) -> np.ndarray:
+    """Returns all block heights of the receiver since the date, oldest first"""
+    block_heights = list(iter_block_heights(receiver, starting_block_date))
+    if len(block_heights) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(block_heights)
+
+
+def iter_block_heights(
+    receiver: str, starting_block_date: str, order: str = "oldest_first"
+):
+    """Yields the block heights of the receiver day by day since the date, in the order"""
+    for bitmap in iter_bitmaps(receiver, starting_block_date, order):
+        if not bitmap["bitmap"]:
+            continue
+        heights = compressed_base64_to_heights(
+            bitmap["first_block_height"], bitmap["bitmap"]
+        )
+        yield heights if order == "oldest_first" else heights[::-1]
+
+
+def iter_bitmaps(
+    receiver: str, starting_block_date: str, order: str = "oldest_first"
+):
+    """
+    Yields the compressed bitmap rows of the receiver since the date ordered by block_date.
+    Closed days come from the bitmap cache when they are in it. The other days are requested
+    BITMAP_PAGE_DAYS rows at a time as they are consumed, and closed days among them are cached
+    once the indexer returned a later day of the receiver, so days the indexer was still behind on
+    are requested again.
+    """
+    if order not in BLOCK_HEIGHT_ORDERS:
+        raise ValueError(
+            f"Unknown order {order}, expected one of {', '.join(BLOCK_HEIGHT_ORDERS)}"
+        )
+    bitmap_cache = get_bitmap_cache()
+    first_open_day = (datetime.now(timezone.utc) - BITMAP_DAY_CLOSE_DELAY).date()
+    day = date.fromisoformat(starting_block_date)
+    days = []
+    while day <= datetime.now(timezone.utc).date():
+        days.append(day.isoformat())
+        day += timedelta(days=1)
+    if order == "newest_first":
+        days.reverse()
+
+    def is_closed(block_date: str) -> bool:
+        return date.fromisoformat(block_date) < first_open_day
+
+    def cache_days_before(newest: str, pending: list) -> list:
+        """Caches the closed (block_date, row) pairs before newest and returns the others"""
+        if bitmap_cache is None or newest is None:
+            return pending
+        later = []
+        for block_date, row in pending:
+            if block_date >= newest:
+                later.append((block_date, row))
+            elif is_closed(block_date):
+                bitmap_cache.put(receiver, block_date, row)
+        return later
 
+    i = 0
+    while i < len(days):
+        if bitmap_cache is not None and is_closed(days[i]):
+            cached, row = bitmap_cache.get(receiver, days[i])
+            if cached:
+                if row is not None:
+                    yield row
+                i += 1
+                continue
+        # the days up to the next cached one are requested together
+        j = i + 1
+        while j < len(days) and not (
+            bitmap_cache is not None
+            and is_closed(days[j])
+            and (receiver, days[j]) in bitmap_cache
+        ):
+            j += 1
+        uncached_days = days[i:j]
+        i = j
+        not_seen = iter(uncached_days)
+        newest = None
+        pending = []
+        for row in _iter_bitmap_pages(
+            receiver, min(uncached_days), max(uncached_days), order
+        ):
+            if row["block_date"] not in uncached_days:
+                yield row
+                continue
+            for block_date in not_seen:
+                if block_date == row["block_date"]:
+                    break
+                # the indexer returns every day with actions, days it skipped have none
+                pending.append((block_date, None))
+            pending.append((row["block_date"], row))
+            newest = max(newest or row["block_date"], row["block_date"])
+            pending = cache_days_before(newest, pending)
+            yield row
+        pending.extend((block_date, None) for block_date in not_seen)
+        cache_days_before(newest, pending)
 
-def graphql_query(receiver: str, starting_block_date: str):
+
+def _iter_bitmap_pages(receiver: str, from_date: str, to_date: str, order: str):
+    offset = 0
+    while True:
+        bitmaps = query_bitmaps(
+            receiver,
+            from_date,
+            to_date,
+            BLOCK_HEIGHT_ORDERS[order],
+            BITMAP_PAGE_DAYS,
+            offset,
+        )
+        yield from bitmaps
+        if len(bitmaps) < BITMAP_PAGE_DAYS:
+            return
+        offset += len(bitmaps)
+
+
+def query_bitmaps(
+    receiver: str,
+    from_date: str,
+    to_date: str,
+    direction: str,
+    limit: int,
+    offset: int,
+) -> [dict]:
     url = "https://near-queryapi.dev.api.pagoda.co/v1/graphql"
     headers = {"Content-Type": "application/json", "x-hasura-role": "darunrs_near"}
 
@@ -31,11 +178,14 @@ def graphql_query(receiver: str, starting_block_date: str):
     query Bitmap {{
       darunrs_near_bitmap_v5_actions_index(
         where: {{
-            block_date: {{_gte: "{starting_block_date}"}}
+            block_date: {{_gte: "{from_date}", _lte: "{to_date}"}}
             receiver: {{
                 receiver: {{_eq: "{receiver}"}}
             }}
         }}
+        order_by: {{block_date: {direction}}}
+        limit: {limit}
+        offset: {offset}
       ) {{
         bitmap
         block_date
@@ -43,32 +193,24 @@ def graphql_query(receiver: str, starting_block_date: str):
       }}
     }}
     """
-    response = requests.post(url, headers=headers, data=json.dumps({"query": query}))
+    response = http_session.post(
+        url, headers=headers, data=json.dumps({"query": query})
+    )
 
     if response.status_code == 200:
-        bitmaps = response.json()["data"]["darunrs_near_bitmap_v5_actions_index"]
-        result = [
-            compressed_base64_to_heights(b["first_block_height"], b["bitmap"])
-            for b in bitmaps
-            if b["bitmap"]
-        ]
-        return flatten(result)
+        return response.json()["data"]["darunrs_near_bitmap_v5_actions_index"]
     else:
         raise Exception(f"Request failed with status code {response.status_code}")
 
 
-def compressed_base64_to_heights(first_block_height, compressed_base64):
+def compressed_base64_to_heights(first_block_height, compressed_base64) -> np.ndarray:
+    """Returns the heights of the set bits of the compressed bitmap as a uint64 array"""
     compressed_bytes = np.frombuffer(
         base64.b64decode(compressed_base64), dtype=np.uint8
     )
     bitmap = decompress_to_bitmap_array(compressed_bytes)
-    heights = []
-    current_height = first_block_height
-    for i in range(len(bitmap) * 8):
-        if get_bit_in_byte_array(bitmap, i):
-            heights.append(current_height + i)
-
-    return heights
+    offsets = np.flatnonzero(np.unpackbits(bitmap)).astype(np.uint64)
+    return offsets + np.uint64(first_block_height)
 
 
 def decode_elias_gamma_entry_from_bytes(bytes_array, start_bit=0):
@@ -84,29 +226,40 @@ def decode_elias_gamma_entry_from_bytes(bytes_array, start_bit=0):
     return {"x": 2**n + remainder, "last_bit": idx + n}
 
 
+# Powers of two for reading Elias-gamma remainders of up to 62 bits, most significant bit first
+_POWERS_OF_TWO = 1 << np.arange(62, -1, -1, dtype=np.int64)
+
+
 def decompress_to_bitmap_array(compressed_bytes):
-    compressed_bit_length = len(compressed_bytes) * 8
-    cur_bit = (compressed_bytes[0] & 0b10000000) > 0
-    result = np.zeros(11000, dtype=np.uint8)
+    """
+    Decodes a compressed bitmap: its first bit is the value of the first run of equal bits, then
+    come the Elias-gamma coded lengths of runs that alternate between 1s and 0s.
+    The position of the next set bit is precomputed for every bit, so each run is decoded with a
+    lookup instead of a bit by bit scan, and the bitmap is built by repeating the run values.
+    """
+    bits = np.unpackbits(np.asarray(compressed_bytes, dtype=np.uint8))
+    bit_length = len(bits)
+    if bit_length == 0:
+        return np.zeros(0, dtype=np.uint8)
+    set_bit_positions = np.where(bits == 1, np.arange(bit_length), bit_length)
+    next_set_bit = np.minimum.accumulate(set_bit_positions[::-1])[::-1]
+
+    run_lengths = []
     compressed_bit_idx = 1
-    result_bit_idx = 0
-
-    while compressed_bit_idx < compressed_bit_length:
-        x, last_bit = decode_elias_gamma_entry_from_bytes(
-            compressed_bytes, compressed_bit_idx
-        ).values()
-        compressed_bit_idx = last_bit + 1
-        if x == 0:
+    while compressed_bit_idx < bit_length:
+        idx = int(next_set_bit[compressed_bit_idx])
+        if idx == bit_length:
             break
+        n = idx - compressed_bit_idx
+        x = 1 << n
+        if n > 0:
+            x += int(bits[idx + 1 : idx + n + 1] @ _POWERS_OF_TWO[-n:])
+        run_lengths.append(x)
+        compressed_bit_idx = idx + n + 1
 
-        for i in range(x):
-            if cur_bit:
-                result = set_bit_in_bitmap(result, result_bit_idx + i, True)
-        result_bit_idx += x
-        cur_bit = not cur_bit
-
-    buffer_length = (result_bit_idx + 7) // 8
-    return result[:buffer_length]
+    first_run_value = 1 if bits[0] else 0
+    run_values = (np.arange(len(run_lengths)) + first_run_value) % 2
+    return np.packbits(np.repeat(run_values.astype(np.uint8), run_lengths))
 
 
 def get_bit_in_byte_array(bytes_array, bit_index):
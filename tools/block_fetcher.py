@@ -0,0 +1,201 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tools import http_session, profiling
+from tools.block_projection import get_projection_store, project_streamer_message
+from tools.block_store import (
+    BlockNotFoundError,
+    get_block_store,
+    get_missing_block_cache,
+)
+from tools.single_flight import SingleFlight, file_range_lock
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Concurrent fetches of one height share a single download, in other threads through
+# SingleFlight and in other processes through a lock on the height's byte of fetch.lock
+_block_fetches = SingleFlight()
+
+
+def fetch_block(height: int) -> str:
+    with profiling.stage("disk_read"):
+        cached = get_block_store().get(height)
+    if cached is not None:
+        return cached.decode("utf-8")
+    if height in get_missing_block_cache():
+        raise BlockNotFoundError(height)
+    return _block_fetches.do(int(height), lambda: _fetch_block_once(int(height)))
+
+
+def _fetch_block_once(height: int) -> str:
+    block_store = get_block_store()
+    with file_range_lock(block_store.path / "fetch.lock", height):
+        cached = block_store.get(height)
+        if cached is not None:
+            return cached.decode("utf-8")
+        legacy_filename = block_store.path / f"{height}.json"
+        if os.path.isfile(legacy_filename):
+            with open(legacy_filename, "rb") as f:
+                data = f.read()
+            os.remove(legacy_filename)
+            try:
+                validate_streamer_message(height, data)
+                block_store.put(height, data)
+                return data.decode("utf-8")
+            except (ValueError, BlockNotFoundError):
+                # older versions cached error responses too, download the block again
+                pass
+        try:
+            data = download_block(height)
+            validate_streamer_message(height, data)
+        except BlockNotFoundError:
+            get_missing_block_cache().add(height)
+            raise
+        block_store.put(height, data)
+        return data.decode("utf-8")
+
+
+# Either an HTTP endpoint serving {BLOCK_SOURCE_URL}/{height} or a file:// directory of {height}.json
+BLOCK_SOURCE_URL = os.getenv(
+    "BLOCK_SOURCE_URL",
+    "https://70jshyr5cb.execute-api.eu-central-1.amazonaws.com/block",
+)
+
+
+def download_block(height: int) -> bytes:
+    """Returns the raw StreamerMessage of the block from BLOCK_SOURCE_URL, bypassing the cache"""
+    with profiling.stage("fetch"):
+        return _download_block(height)
+
+
+def _download_block(height: int) -> bytes:
+    if BLOCK_SOURCE_URL.startswith("file://"):
+        path = os.path.join(BLOCK_SOURCE_URL[len("file://") :], f"{height}.json")
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BlockNotFoundError(height)
+    response = http_session.get(f"{BLOCK_SOURCE_URL.rstrip('/')}/{height}")
+    if response.status_code == 404:
+        raise BlockNotFoundError(height)
+    response.raise_for_status()
+    return response.content
+
+
+def validate_streamer_message(height: int, data: bytes):
+    """Raises if data is not a StreamerMessage, so that error bodies never get cached"""
+    try:
+        streamer_message = parse_block(data)
+    except ValueError as e:
+        raise ValueError(f"Block {height} response is not valid JSON: {e}")
+    if streamer_message is None:
+        raise BlockNotFoundError(height)
+    if not isinstance(streamer_message, dict) or not {"block", "shards"}.issubset(
+        streamer_message
+    ):
+        raise ValueError(f"Block {height} response is not a StreamerMessage")
+
+
+def parse_block(data) -> dict:
+    """Parses StreamerMessage JSON from a str, bytes or memoryview, orjson reads a memoryview in place"""
+    with profiling.stage("json_loads"):
+        if orjson is not None:
+            return orjson.loads(data)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+def load_block(height: int) -> dict:
+    """Returns the parsed StreamerMessage of the block, reading cached blocks through a memory map"""
+    return load_block_with_size(height)[0]
+
+
+def load_block_with_size(height: int) -> (dict, int):
+    """Returns the parsed StreamerMessage and the size of its JSON in bytes"""
+    view = get_block_store().get_view(height)
+    if view is None:
+        streamer_message = fetch_block(height)
+        return parse_block(streamer_message), len(streamer_message)
+    with view:
+        return parse_block(view), view.nbytes
+
+
+def load_projected_block(height: int, receiver: str) -> dict:
+    """Returns the StreamerMessage of the block with only the shard data that involves the receiver"""
+    return load_projected_block_with_size(height, receiver)[0]
+
+
+def load_projected_block_with_size(height: int, receiver: str) -> (dict, int):
+    """Returns the parsed projection of the block to the receiver and the size of its JSON in bytes"""
+    projection_store = get_projection_store(receiver)
+    view = projection_store.get_view(height)
+    if view is None:
+        streamer_message = load_block(height)
+        with profiling.stage("projection"):
+            projection = project_streamer_message(streamer_message, receiver)
+            data = json.dumps(projection, separators=(",", ":")).encode("utf-8")
+            projection_store.put(height, data)
+        return projection, len(data)
+    with view:
+        return parse_block(view), view.nbytes
+
+
+def load_block_data(height: int, receiver: str = None) -> bytes:
+    """Returns the raw StreamerMessage JSON of the block, or of its projection to the receiver"""
+    if receiver is None:
+        with profiling.stage("disk_read"):
+            data = get_block_store().get(height)
+        return data if data is not None else fetch_block(height).encode("utf-8")
+    with profiling.stage("disk_read"):
+        data = get_projection_store(receiver).get(height)
+    if data is None:
+        load_projected_block(height, receiver)
+        data = get_projection_store(receiver).get(height)
+    return data
+
+
+BLOCK_PREFETCH_CONCURRENCY = int(os.getenv("BLOCK_PREFETCH_CONCURRENCY", "8"))
+
+
+def prefetch_blocks(
+    block_heights: [int], max_in_flight: int = None, on_fetched=None
+) -> [int]:
+    """
+    Downloads the given block heights into the block store concurrently, with at most
+    max_in_flight requests running at the same time. Heights that are already cached are skipped.
+    :param block_heights: block heights to fetch
+    :param max_in_flight: limit of concurrent downloads, default is BLOCK_PREFETCH_CONCURRENCY
+    :param on_fetched: optional callback(height, error) called as every download finishes,
+        error is None on success
+    :return: block heights that were downloaded
+    """
+    if max_in_flight is None:
+        max_in_flight = BLOCK_PREFETCH_CONCURRENCY
+    block_store = get_block_store()
+    missing = [
+        height for height in dict.fromkeys(block_heights) if height not in block_store
+    ]
+    if len(missing) == 0:
+        return []
+
+    fetched = set()
+    workers = max(1, min(max_in_flight, len(missing)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(profiling.bind(fetch_block), h): h for h in missing}
+        for future in as_completed(futures):
+            height = futures[future]
+            error = future.exception()
+            if error is None:
+                fetched.add(height)
+            elif not isinstance(error, BlockNotFoundError):
+                print(f"Failed to prefetch block {height}: {error}")
+            if on_fetched is not None:
+                on_fetched(height, error)
+    return [height for height in missing if height in fetched]
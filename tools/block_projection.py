@@ -0,0 +1,94 @@
+import os
+import re
+import threading
+
+from tools.block_store import BlockStore, get_block_store
+
+# Run the schema tools on blocks projected down to their receiver instead of whole blocks
+BLOCK_PROJECTION = os.getenv("BLOCK_PROJECTION", "0").lower() in ("1", "true", "yes")
+# Disk budget of the projection cache of every receiver, 0 is unlimited
+BLOCK_PROJECTION_CACHE_MAX_BYTES = int(
+    os.getenv("BLOCK_PROJECTION_CACHE_MAX_BYTES", os.getenv("BLOCK_CACHE_MAX_BYTES", "0"))
+)
+
+
+def project_streamer_message(streamer_message: dict, receiver: str) -> dict:
+    """
+    Returns a copy of the StreamerMessage that keeps the block header and, from every shard, only
+    the transactions, receipts, execution outcomes and state changes that involve the receiver,
+    either as receiver or as signer/predecessor. Shards with nothing left are dropped.
+    """
+    shards = []
+    for shard in streamer_message.get("shards") or []:
+        outcomes = [
+            outcome
+            for outcome in shard.get("receiptExecutionOutcomes") or []
+            if receiver
+            in (
+                outcome["receipt"].get("receiverId"),
+                outcome["receipt"].get("predecessorId"),
+            )
+        ]
+        state_changes = [
+            state_change
+            for state_change in shard.get("stateChanges") or []
+            if (state_change.get("change") or {}).get("accountId") == receiver
+        ]
+        chunk = shard.get("chunk")
+        if chunk is not None:
+            chunk = {
+                **chunk,
+                "transactions": [
+                    transaction
+                    for transaction in chunk.get("transactions") or []
+                    if receiver
+                    in (
+                        transaction["transaction"].get("receiverId"),
+                        transaction["transaction"].get("signerId"),
+                    )
+                ],
+                "receipts": [
+                    receipt
+                    for receipt in chunk.get("receipts") or []
+                    if receiver in (receipt.get("receiverId"), receipt.get("predecessorId"))
+                ],
+            }
+        if (
+            outcomes
+            or state_changes
+            or (chunk is not None and (chunk["transactions"] or chunk["receipts"]))
+        ):
+            shards.append(
+                {
+                    **shard,
+                    "chunk": chunk,
+                    "receiptExecutionOutcomes": outcomes,
+                    "stateChanges": state_changes,
+                }
+            )
+    return {**streamer_message, "shards": shards}
+
+
+_projection_stores = {}
+_projection_stores_lock = threading.Lock()
+
+
+def get_projection_store(receiver: str) -> BlockStore:
+    """
+    Block store of projections for the receiver, next to the full block cache, evicting least
+    recently used segments beyond BLOCK_PROJECTION_CACHE_MAX_BYTES
+    """
+    store = _projection_stores.get(receiver)
+    if store is None:
+        block_store = get_block_store()
+        with _projection_stores_lock:
+            store = _projection_stores.get(receiver)
+            if store is None:
+                directory = re.sub(r"[^a-z0-9._-]", "_", receiver.lower())
+                store = BlockStore(
+                    block_store.path / "projections" / directory,
+                    compression=block_store.compression,
+                    max_bytes=BLOCK_PROJECTION_CACHE_MAX_BYTES,
+                )
+                _projection_stores[receiver] = store
+    return store
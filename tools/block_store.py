@@ -0,0 +1,434 @@
+import gzip
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from tools.single_flight import file_range_lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# height, segment, offset, length
+INDEX_RECORD = struct.Struct("<QIQI")
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+# Each segment holds records of one codec, the codec is encoded in the segment file suffix
+CODEC_SUFFIXES = {"none": ".dat", "gzip": ".gz", "zstd": ".zst"}
+
+
+class BlockStore:
+    """
+    Packed block cache: raw StreamerMessage payloads are appended to segment files and
+    a height -> (segment, offset, length) index is appended to index.bin.
+    Reading a block is one lookup in the in-memory index and one pread from a segment.
+
+    Writes from several threads and processes are serialized by a lock on write.lock.
+    A block is only visible once its index record is written after its data, so a torn write
+    leaves unreferenced bytes in a segment rather than a corrupt cache entry.
+    Records can be compressed one by one with gzip or zstd. When max_bytes is set, whole
+    segments are evicted in least-recently-used order to keep the cache under that size.
+    """
+
+    def __init__(
+        self,
+        path=".blockcache",
+        compression="none",
+        max_bytes=0,
+        segment_max_bytes=None,
+    ):
+        if compression not in CODEC_SUFFIXES:
+            raise ValueError(
+                f"Unknown block cache compression '{compression}', expected one of {list(CODEC_SUFFIXES)}"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ValueError(
+                "Block cache compression 'zstd' requires the zstandard package, run `pip install zstandard`"
+            )
+        if segment_max_bytes is None:
+            segment_max_bytes = SEGMENT_MAX_BYTES
+            if max_bytes:
+                # keep eviction granular enough to stay close to the budget
+                segment_max_bytes = max(1, min(segment_max_bytes, max_bytes // 8))
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / "index.bin"
+        self.lock_path = self.path / "write.lock"
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = threading.RLock()
+        self._index = {}
+        self._index_inode = None
+        self._index_bytes_read = 0
+        self._read_fds = {}
+        self._maps = {}
+        self._segment_paths = {}
+        self._segment_sizes = {}
+        self._recently_used = OrderedDict()
+        self._scan_segments()
+        self._active_segment = max(self._segment_paths, default=0)
+        self._load_index()
+
+    def segment_path(self, segment: int, compression: str = None) -> Path:
+        path = self._segment_paths.get(segment)
+        if path is None:
+            suffix = CODEC_SUFFIXES[compression or self.compression]
+            path = self.path / f"segment-{segment:06d}{suffix}"
+        return path
+
+    def segments(self) -> [int]:
+        with self._lock:
+            return sorted(self._segment_paths)
+
+    def heights(self) -> [int]:
+        with self._lock:
+            return sorted(self._index)
+
+    def size(self) -> int:
+        """Total size of the segment files in bytes"""
+        with self._lock:
+            return sum(self._segment_sizes.values())
+
+    def __contains__(self, height: int) -> bool:
+        return self.locate(height) is not None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def locate(self, height: int) -> Optional[tuple]:
+        """Returns (segment, offset, length) of the block, picking up records appended by other writers"""
+        height = int(height)
+        location = self._index.get(height)
+        if location is None:
+            with self._lock:
+                self._load_index()
+                location = self._index.get(height)
+        return location
+
+    def get(self, height: int) -> Optional[bytes]:
+        location = self.locate(height)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with self._lock:
+            try:
+                data = os.pread(self._read_fd(segment), length, offset)
+            except FileNotFoundError:
+                # the segment was evicted by another writer
+                self._load_index()
+                return None
+        self._touch(segment)
+        return self._decode(segment, data)
+
+    def get_view(self, height: int) -> Optional[memoryview]:
+        """
+        Returns the block as a memoryview without copying it into a Python string.
+        Uncompressed blocks are a slice of a memory-mapped segment, compressed blocks are
+        decompressed straight from the mapping. Release the view once it is parsed.
+        """
+        location = self.locate(height)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with self._lock:
+            try:
+                segment_map = self._map(segment, offset + length)
+            except FileNotFoundError:
+                # the segment was evicted by another writer
+                self._load_index()
+                return None
+            view = memoryview(segment_map)[offset : offset + length]
+        self._touch(segment)
+        if self.segment_path(segment).name.endswith(CODEC_SUFFIXES["none"]):
+            return view
+        with view:
+            return memoryview(self._decode(segment, view))
+
+    def _map(self, segment: int, min_length: int) -> mmap.mmap:
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < min_length:
+            # the segment has grown since it was mapped, views of the old mapping keep it alive
+            segment_map = mmap.mmap(self._read_fd(segment), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def put(self, height: int, data: bytes):
+        height = int(height)
+        payload = self._encode(data)
+        with self._lock, file_range_lock(self.lock_path):
+            self._load_index()
+            if height in self._index:
+                return
+            # other processes may have opened or evicted segments since the last write
+            self._scan_segments()
+            self._active_segment = max(self._segment_paths, default=0)
+            segment = self._active_segment
+            segment_path = self.segment_path(segment)
+            if segment_path.exists() and (
+                not segment_path.name.endswith(CODEC_SUFFIXES[self.compression])
+                or segment_path.stat().st_size + len(payload) > self.segment_max_bytes
+            ):
+                segment = max(self._segment_paths, default=segment) + 1
+                segment_path = self.segment_path(segment)
+            fd = os.open(segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                offset = os.lseek(fd, 0, os.SEEK_END)
+                _write_all(fd, payload)
+            finally:
+                os.close(fd)
+            self._segment_paths[segment] = segment_path
+            self._segment_sizes[segment] = offset + len(payload)
+            self._recently_used[segment] = None
+            self._recently_used.move_to_end(segment)
+            self._append_index_record(height, segment, offset, len(payload))
+            self._active_segment = segment
+            if self.max_bytes:
+                self._evict()
+
+    def _encode(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return data
+
+    def _decode(self, segment: int, data: bytes) -> bytes:
+        name = self.segment_path(segment).name
+        if name.endswith(CODEC_SUFFIXES["gzip"]):
+            return gzip.decompress(data)
+        if name.endswith(CODEC_SUFFIXES["zstd"]):
+            if zstandard is None:
+                raise ValueError(
+                    f"Block cache segment {name} is zstd compressed, run `pip install zstandard`"
+                )
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def _touch(self, segment: int):
+        """Marks the segment as most recently used, the mtime keeps the order across restarts"""
+        with self._lock:
+            if next(reversed(self._recently_used), None) == segment:
+                return
+            if segment in self._recently_used:
+                self._recently_used.move_to_end(segment)
+                try:
+                    os.utime(self._segment_paths[segment])
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        """Removes least recently used segments until the cache fits in max_bytes"""
+        evicted = set()
+        for segment in list(self._recently_used):
+            if sum(self._segment_sizes.values()) <= self.max_bytes:
+                break
+            # never evict the newest segment, so segment numbers are not reused
+            if segment == self._active_segment:
+                continue
+            self._unmap(segment)
+            fd = self._read_fds.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+            try:
+                os.remove(self._segment_paths[segment])
+            except FileNotFoundError:
+                pass
+            del self._segment_paths[segment]
+            del self._segment_sizes[segment]
+            del self._recently_used[segment]
+            evicted.add(segment)
+        if evicted:
+            self._index = {
+                height: location
+                for height, location in self._index.items()
+                if location[0] not in evicted
+            }
+            self._rewrite_index()
+
+    def _rewrite_index(self):
+        """Replaces index.bin with the current index sorted by height"""
+        records = b"".join(
+            INDEX_RECORD.pack(height, *self._index[height])
+            for height in sorted(self._index)
+        )
+        write_atomically(self.index_path, records)
+        self._index_inode = os.stat(self.index_path).st_ino
+        self._index_bytes_read = len(records)
+
+    def _append_index_record(self, height, segment, offset, length):
+        record = INDEX_RECORD.pack(height, segment, offset, length)
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            _write_all(fd, record)
+        finally:
+            os.close(fd)
+        self._index[height] = (segment, offset, length)
+        self._index_bytes_read += len(record)
+
+    def _load_index(self):
+        """Reads index records appended since the last load, a torn trailing record is ignored"""
+        try:
+            with open(self.index_path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._index_inode:
+                    # the index was rewritten after an eviction, load it from scratch
+                    self._index = {}
+                    self._index_bytes_read = 0
+                    self._index_inode = inode
+                    self._scan_segments()
+                f.seek(self._index_bytes_read)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        whole = len(data) - len(data) % INDEX_RECORD.size
+        for height, segment, offset, length in INDEX_RECORD.iter_unpack(data[:whole]):
+            self._index[height] = (segment, offset, length)
+        self._index_bytes_read += whole
+
+    def _scan_segments(self):
+        segments = []
+        for path in self.path.glob("segment-*"):
+            number, suffix = path.name[len("segment-") :].split(".", 1)
+            if f".{suffix}" not in CODEC_SUFFIXES.values():
+                continue
+            stat = path.stat()
+            segments.append((stat.st_mtime, int(number), path, stat.st_size))
+        self._segment_paths = {}
+        self._segment_sizes = {}
+        self._recently_used = OrderedDict()
+        for _, segment, path, size in sorted(segments):
+            self._segment_paths[segment] = path
+            self._segment_sizes[segment] = size
+            self._recently_used[segment] = None
+
+    def _read_fd(self, segment: int) -> int:
+        fd = self._read_fds.get(segment)
+        if fd is None:
+            if segment not in self._segment_paths:
+                self._scan_segments()
+            fd = os.open(self.segment_path(segment), os.O_RDONLY)
+            self._read_fds[segment] = fd
+        return fd
+
+    def _unmap(self, segment: int):
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            try:
+                segment_map.close()
+            except BufferError:
+                # a view is still in use, the mapping is released together with it
+                pass
+
+    def close(self):
+        with self._lock:
+            for segment in list(self._maps):
+                self._unmap(segment)
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds = {}
+
+
+class BlockNotFoundError(Exception):
+    """The block source has no block at this height, NEAR skips some heights"""
+
+    def __init__(self, height: int):
+        super().__init__(f"Block height {height} does not exist")
+        self.height = height
+
+
+class MissingBlockCache:
+    """
+    Negative cache of heights the block source reported as missing, kept for ttl seconds
+    in missing.json so that skipped heights are not requested again on every agent iteration.
+    """
+
+    def __init__(self, path, ttl: float):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(".lock")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires_at = {}
+        self._mtime = None
+
+    def __contains__(self, height: int) -> bool:
+        with self._lock:
+            self._load()
+            return self._expires_at.get(int(height), 0) > time.time()
+
+    def add(self, height: int):
+        if self.ttl <= 0:
+            return
+        with self._lock, file_range_lock(self.lock_path):
+            self._load()
+            now = time.time()
+            self._expires_at = {
+                h: expires_at
+                for h, expires_at in self._expires_at.items()
+                if expires_at > now
+            }
+            self._expires_at[int(height)] = now + self.ttl
+            write_atomically(self.path, json.dumps(self._expires_at).encode("utf-8"))
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r") as f:
+            self._expires_at = {int(h): t for h, t in json.load(f).items()}
+        self._mtime = mtime
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def write_atomically(path: Path, data: bytes):
+    """Writes the file through a temporary file and a rename, readers never see a partial file"""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+_block_store = None
+_missing_blocks = None
+_block_store_lock = threading.Lock()
+
+
+def get_block_store() -> BlockStore:
+    global _block_store
+    if _block_store is None:
+        with _block_store_lock:
+            if _block_store is None:
+                _block_store = BlockStore(
+                    os.getenv("BLOCK_CACHE_DIR", ".blockcache"),
+                    compression=os.getenv("BLOCK_CACHE_COMPRESSION", "none"),
+                    max_bytes=int(os.getenv("BLOCK_CACHE_MAX_BYTES", "0")),
+                )
+    return _block_store
+
+
+def get_missing_block_cache() -> MissingBlockCache:
+    global _missing_blocks
+    if _missing_blocks is None:
+        block_store = get_block_store()
+        with _block_store_lock:
+            if _missing_blocks is None:
+                _missing_blocks = MissingBlockCache(
+                    block_store.path / "missing.json",
+                    ttl=float(os.getenv("MISSING_BLOCK_TTL_SECONDS", "600")),
+                )
+    return _missing_blocks
@@ -0,0 +1,21 @@
+// Freezes a parsed StreamerMessage and everything in it. Messages are cached and shared by the
+// runs of extraction code on their block, each run builds its own primitives.Block on top of the
+// frozen message, so code that changes the block data cannot change it for later runs.
+// Used by tools/js_worker.js and the in-process runner of tools/JavaScriptRunner.py.
+
+function deepFreeze(value) {
+  const stack = [value];
+  while (stack.length) {
+    const item = stack.pop();
+    if (item === null || typeof item !== "object" || Object.isFrozen(item)) {
+      continue;
+    }
+    Object.freeze(item);
+    for (const child of Object.values(item)) {
+      stack.push(child);
+    }
+  }
+  return value;
+}
+
+module.exports = { deepFreeze };
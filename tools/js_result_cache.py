@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from tools.block_store import get_block_store
+from tools.js_worker_pool import JsError
+
+# Remember results of extraction code per block, 0 disables it
+JS_RESULT_CACHE_TTL_SECONDS = float(os.getenv("JS_RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Most parameters sqlite binds in one statement on old versions
+SQLITE_MAX_VARIABLES = 900
+# Version of how extraction code is run, bump it whenever a change to the runners can change
+# results, so that results of the previous runners are not served
+JS_RUNNER_VERSION = 4
+PRIMITIVES_PACKAGE_JSON = os.path.join(
+    os.path.dirname(__file__), "../node_modules/@near-lake/primitives/package.json"
+)
+
+
+def _primitives_version() -> str:
+    try:
+        with open(PRIMITIVES_PACKAGE_JSON, "r") as f:
+            return json.load(f)["version"]
+    except (OSError, ValueError, KeyError):
+        return "unknown"
+
+
+class JsResultCache:
+    """
+    Results of extraction code by (normalized code hash, block key) in a sqlite database, shared by
+    processes on the same block cache directory. A result is the JSON result or the error the code
+    threw, rows older than ttl seconds are dropped when the cache is opened.
+    Only JsError is cached among errors, missing blocks and limit errors have to be retried.
+    Code hashes are stored with the runner and @near-lake/primitives versions, so results of
+    other versions are never returned.
+    """
+
+    def __init__(self, path, ttl: float = JS_RESULT_CACHE_TTL_SECONDS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.version = f"{JS_RUNNER_VERSION}-{_primitives_version()}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                    js_hash TEXT NOT NULL,
+                    block_key TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (js_hash, block_key)
+                ) WITHOUT ROWID"""
+            )
+            self._db.execute(
+                "DELETE FROM results WHERE created_at < ?", (time.time() - ttl,)
+            )
+
+    def get_many(self, js_hash: str, block_keys: [str]) -> dict:
+        """Returns the cached results of the block keys that have one, errors as JsError"""
+        found = {}
+        block_keys = list(dict.fromkeys(block_keys))
+        with self._lock:
+            for i in range(0, len(block_keys), SQLITE_MAX_VARIABLES):
+                keys = block_keys[i : i + SQLITE_MAX_VARIABLES]
+                rows = self._db.execute(
+                    f"SELECT block_key, result, error FROM results "
+                    f"WHERE js_hash = ? AND created_at >= ? AND block_key IN ({', '.join('?' * len(keys))})",
+                    (self._versioned(js_hash), time.time() - self.ttl, *keys),
+                ).fetchall()
+                for block_key, result, error in rows:
+                    found[block_key] = (
+                        JsError(json.loads(error)) if error is not None else json.loads(result)
+                    )
+        return found
+
+    def put_many(self, js_hash: str, results: dict):
+        """Stores results by block key, values that are other exceptions than JsError are skipped"""
+        now = time.time()
+        js_hash = self._versioned(js_hash)
+        rows = []
+        for block_key, result in results.items():
+            if type(result) is JsError:
+                rows.append((js_hash, block_key, None, json.dumps(result.error), now))
+            elif not isinstance(result, Exception):
+                rows.append((js_hash, block_key, json.dumps(result), None, now))
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def _versioned(self, js_hash: str) -> str:
+        return f"{self.version}:{js_hash}"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_js_result_cache = None
+_js_result_cache_lock = threading.Lock()
+
+
+def get_js_result_cache():
+    """Returns the result cache next to the block cache, or None when it is disabled"""
+    global _js_result_cache
+    if JS_RESULT_CACHE_TTL_SECONDS <= 0:
+        return None
+    if _js_result_cache is None:
+        block_store = get_block_store()
+        with _js_result_cache_lock:
+            if _js_result_cache is None:
+                _js_result_cache = JsResultCache(block_store.path / "js_results.sqlite")
+    return _js_result_cache
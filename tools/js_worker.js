@@ -0,0 +1,342 @@
+// Long-lived worker of tools/js_worker_pool.py that runs extraction code on NEAR Lake blocks.
+//
+// Requests and responses are JSON frames prefixed with their length as a 4 byte big-endian
+// integer, on stdin and stdout. console output of the extraction code goes to stderr.
+//
+//   {id, op: "ping"}                          -> {id, ok: true}
+//   {id, op: "stats"}                         -> {id, hits, misses, entries, bytes, functions, compiled}
+//   {id, op: "run_batch", js, js_hash, blocks: [{key, message?}]}
+//                                             -> {id, results: [{result} | {error} | {missing_block: true}]}
+//
+// Requests with profile: true are answered with timings: {compile, parse, run}, the milliseconds
+// spent compiling the code, parsing blocks with Block.fromStreamerMessage and running the code.
+//
+// StreamerMessages are kept in an LRU keyed by `key`, bounded by PARSED_BLOCK_CACHE_MAX_BYTES of
+// their JSON, so `message` is only sent when the worker replies with missing_block. Cached
+// messages are frozen and every run gets its own Block built on them, see deep_freeze.js.
+// Compiled scripts are kept in an LRU of COMPILED_FUNCTION_CACHE_SIZE entries keyed by
+// `js_hash`, the hash of the normalized `js`, so repeated code is not parsed again.
+//
+// The code is the body of an async function of `block` and its result is awaited, like eval_js
+// of the Python bridge, which also returns single lines without "return ". Every run on a block
+// gets a new vm context and console, so the globals the code sets are not seen by runs on other
+// blocks and every result only depends on its block. This is not a sandbox: Buffer and the other
+// globals it is given are shared with the worker. Each run, including the promises it awaits, is
+// stopped after JS_EXECUTION_TIMEOUT_SECONDS with a TimeoutError. Requests are answered in the
+// order they arrive.
+
+const path = require("path");
+const util = require("util");
+const vm = require("vm");
+const primitives = require(path.join(__dirname, "../node_modules/@near-lake/primitives"));
+const { deepFreeze } = require("./deep_freeze");
+
+const maxBlockBytes = parseInt(process.env.PARSED_BLOCK_CACHE_MAX_BYTES || String(128 * 1024 * 1024));
+const blocks = new Map();
+let blockBytes = 0;
+let hits = 0;
+let misses = 0;
+
+const maxFunctions = parseInt(process.env.COMPILED_FUNCTION_CACHE_SIZE || "256");
+const functions = new Map();
+let compiled = 0;
+
+const timeoutMs = Math.round(parseFloat(process.env.JS_EXECUTION_TIMEOUT_SECONDS || "5") * 1000);
+const callScript = new vm.Script("extract(block).then(resolve, reject)");
+const drainScript = new vm.Script("");
+
+for (const method of ["log", "info", "debug", "warn"]) {
+  console[method] = (...args) => process.stderr.write(args.map(String).join(" ") + "\n");
+}
+
+function getMessage(key) {
+  const entry = blocks.get(key);
+  if (entry === undefined) {
+    misses += 1;
+    return undefined;
+  }
+  hits += 1;
+  blocks.delete(key);
+  blocks.set(key, entry);
+  return entry.message;
+}
+
+function putMessage(key, message, size) {
+  if (size > maxBlockBytes) {
+    return;
+  }
+  deepFreeze(message);
+  const previous = blocks.get(key);
+  if (previous !== undefined) {
+    blockBytes -= previous.size;
+    blocks.delete(key);
+  }
+  blocks.set(key, { message, size });
+  blockBytes += size;
+  for (const [oldestKey, oldest] of blocks) {
+    if (blockBytes <= maxBlockBytes) {
+      break;
+    }
+    blocks.delete(oldestKey);
+    blockBytes -= oldest.size;
+  }
+}
+
+function timeoutError() {
+  const e = new Error(`Script execution timed out after ${timeoutMs}ms`);
+  e.code = "ERR_SCRIPT_EXECUTION_TIMEOUT";
+  return e;
+}
+
+function serializeError(e) {
+  if (e && e.code === "ERR_SCRIPT_EXECUTION_TIMEOUT") {
+    return { name: "TimeoutError", message: e.message, code: e.code };
+  }
+  // errors thrown inside a vm context are not instances of this context's Error
+  if (util.types.isNativeError(e)) {
+    return { name: e.name, message: e.message, stack: e.stack };
+  }
+  return { name: "Error", message: String(e) };
+}
+
+// Returns a new Block of the given or cached message. Blocks memoize what their methods return,
+// like the receipts array, so they are never shared between runs.
+function getOrParseBlock(key, message, size, timings) {
+  // a block that carries the message follows a missing_block reply, which counted the miss
+  const startedAt = performance.now();
+  try {
+    if (message === undefined) {
+      message = getMessage(key);
+      if (message === undefined) {
+        return undefined;
+      }
+    } else {
+      putMessage(key, message, size);
+    }
+    return primitives.Block.fromStreamerMessage(message);
+  } finally {
+    timings.parse += performance.now() - startedAt;
+  }
+}
+
+// Runs the code on the block and returns what its promise settles with. Jobs of a context in
+// microtaskMode "afterEvaluate" run at the end of every evaluation in it, within its timeout, so
+// code that awaits promises settled later is evaluated again until it is done or out of time.
+async function callExtract(context, block) {
+  const deadline = performance.now() + timeoutMs;
+  let outcome;
+  context.block = block;
+  context.resolve = (result) => (outcome = { result });
+  context.reject = (error) => (outcome = { error });
+  callScript.runInContext(context, { timeout: timeoutMs });
+  while (outcome === undefined) {
+    const remaining = Math.ceil(deadline - performance.now());
+    if (remaining <= 0) {
+      throw timeoutError();
+    }
+    await new Promise((resolve) => setTimeout(resolve, 1));
+    drainScript.runInContext(context, { timeout: remaining });
+  }
+  if ("error" in outcome) {
+    throw outcome.error;
+  }
+  return outcome.result;
+}
+
+// Returns a new vm context whose `extract` function is the compiled code
+function newContext(script) {
+  const context = vm.createContext(
+    { console: { ...console }, Buffer, TextDecoder, TextEncoder, atob, btoa },
+    { microtaskMode: "afterEvaluate" }
+  );
+  script.runInContext(context);
+  return context;
+}
+
+async function runOnBlock(script, key, message, size, timings) {
+  try {
+    const block = getOrParseBlock(key, message, size, timings);
+    if (block === undefined) {
+      return { missing_block: true };
+    }
+    const startedAt = performance.now();
+    try {
+      const result = await callExtract(newContext(script), block);
+      return { result: result === undefined ? null : result };
+    } finally {
+      timings.run += performance.now() - startedAt;
+    }
+  } catch (e) {
+    return { error: serializeError(e) };
+  }
+}
+
+// Returns a vm.Script that defines the compiled code as the `extract` function of a context
+function compile(js, jsHash) {
+  let script = jsHash === undefined ? undefined : functions.get(jsHash);
+  if (script !== undefined) {
+    functions.delete(jsHash);
+    functions.set(jsHash, script);
+    return script;
+  }
+  // a single line without "return " is an expression whose value is returned, like in eval_js
+  const body = js.split("\n").length === 1 && !js.includes("return ") ? `return ${js}` : js;
+  script = new vm.Script(`extract = async function (block) {\n${body}\n}`);
+  compiled += 1;
+  if (jsHash !== undefined && maxFunctions > 0) {
+    functions.set(jsHash, script);
+    if (functions.size > maxFunctions) {
+      functions.delete(functions.keys().next().value);
+    }
+  }
+  return script;
+}
+
+function newTimings() {
+  return { compile: 0, parse: 0, run: 0 };
+}
+
+function compileTimed(request, timings) {
+  const startedAt = performance.now();
+  try {
+    return compile(request.js, request.js_hash);
+  } finally {
+    timings.compile += performance.now() - startedAt;
+  }
+}
+
+function withTimings(request, response, timings) {
+  return request.profile ? { ...response, timings } : response;
+}
+
+async function runBatch(request, size) {
+  const timings = newTimings();
+  let script;
+  try {
+    script = compileTimed(request, timings);
+  } catch (e) {
+    return withTimings(request, { id: request.id, error: serializeError(e) }, timings);
+  }
+  // the frame size is shared evenly as the cache size estimate of the blocks it carries
+  const withMessage = request.blocks.filter((b) => b.message !== undefined).length;
+  const blockSize = withMessage ? Math.ceil(size / withMessage) : 0;
+  const results = [];
+  for (const b of request.blocks) {
+    const result = await runOnBlock(script, b.key, b.message, blockSize, timings);
+    results.push(result);
+    if (result.error && result.error.name === "TimeoutError") {
+      // the code would most likely time out on the remaining blocks as well
+      while (results.length < request.blocks.length) {
+        results.push(result);
+      }
+      break;
+    }
+  }
+  return withTimings(request, { id: request.id, results }, timings);
+}
+
+async function handle(request, size) {
+  switch (request.op) {
+    case "ping":
+      return { id: request.id, ok: true };
+    case "stats":
+      return {
+        id: request.id,
+        hits,
+        misses,
+        entries: blocks.size,
+        bytes: blockBytes,
+        functions: functions.size,
+        compiled,
+      };
+    case "run_batch":
+      return runBatch(request, size);
+    default:
+      return { id: request.id, error: { name: "Error", message: `Unknown op ${request.op}` } };
+  }
+}
+
+function bigIntToString(key, value) {
+  return typeof value === "bigint" ? value.toString() : value;
+}
+
+function send(response) {
+  let payload;
+  try {
+    payload = Buffer.from(JSON.stringify(response, bigIntToString));
+  } catch (e) {
+    payload = Buffer.from(JSON.stringify({ id: response.id, error: serializeError(e) }));
+  }
+  const header = Buffer.alloc(4);
+  header.writeUInt32BE(payload.length);
+  process.stdout.write(Buffer.concat([header, payload]));
+}
+
+// stdin chunks are kept as they arrive and copied once into the frame they belong to
+const chunks = [];
+let bufferedLength = 0;
+let frameLength;
+
+// Removes the first `length` buffered bytes and returns them as one buffer
+function take(length) {
+  bufferedLength -= length;
+  if (length === 0) {
+    return Buffer.alloc(0);
+  }
+  const first = chunks[0];
+  if (first.length >= length) {
+    if (first.length === length) {
+      chunks.shift();
+    } else {
+      chunks[0] = first.subarray(length);
+    }
+    return first.subarray(0, length);
+  }
+  const taken = Buffer.allocUnsafe(length);
+  let offset = 0;
+  while (offset < length) {
+    const chunk = chunks[0];
+    const n = Math.min(chunk.length, length - offset);
+    chunk.copy(taken, offset, 0, n);
+    offset += n;
+    if (n === chunk.length) {
+      chunks.shift();
+    } else {
+      chunks[0] = chunk.subarray(n);
+    }
+  }
+  return taken;
+}
+
+// requests are handled one after the other so that responses keep their order
+let handled = Promise.resolve();
+process.stdin.on("data", (chunk) => {
+  chunks.push(chunk);
+  bufferedLength += chunk.length;
+  for (;;) {
+    if (frameLength === undefined) {
+      if (bufferedLength < 4) {
+        break;
+      }
+      frameLength = take(4).readUInt32BE(0);
+    }
+    if (bufferedLength < frameLength) {
+      break;
+    }
+    const length = frameLength;
+    const frame = take(length);
+    frameLength = undefined;
+    let request;
+    try {
+      request = JSON.parse(frame);
+    } catch (e) {
+      const error = serializeError(e);
+      handled = handled.then(() => send({ id: null, error }));
+      continue;
+    }
+    handled = handled
+      .then(() => handle(request, length))
+      .then(send, (e) => send({ id: request.id, error: serializeError(e) }));
+  }
+});
+process.stdin.on("end", () => process.exit(0));
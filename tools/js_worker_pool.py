@@ -0,0 +1,346 @@
+import hashlib
+import itertools
+import json
+import os
+import queue
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from tools import profiling
+from tools.block_fetcher import load_block_data
+
+JS_WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), "js_worker.js")
+JS_WORKER_POOL_SIZE = int(os.getenv("JS_WORKER_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+JS_WORKER_HEALTH_CHECK_SECONDS = float(os.getenv("JS_WORKER_HEALTH_CHECK_SECONDS", "30"))
+# Most blocks sent to one worker in one call, longer lists of heights are split across workers
+JS_BATCH_MAX_BLOCKS = int(os.getenv("JS_BATCH_MAX_BLOCKS", "64"))
+# Most StreamerMessage bytes sent to one worker in one call, larger batches are sent in parts
+JS_BATCH_MAX_BYTES = int(os.getenv("JS_BATCH_MAX_BYTES", str(32 * 1024 * 1024)))
+# Limits of agent-generated code, the timeout is also read by js_worker.js
+JS_EXECUTION_TIMEOUT_SECONDS = float(os.getenv("JS_EXECUTION_TIMEOUT_SECONDS", "5"))
+JS_WORKER_MAX_HEAP_MB = int(os.getenv("JS_WORKER_MAX_HEAP_MB", "512"))
+# Time for parsing blocks and serializing results on top of the execution timeout
+WATCHDOG_SLACK_SECONDS = 10.0
+FRAME_HEADER = struct.Struct(">I")
+
+
+class JsError(Exception):
+    """Exception thrown by Javascript code in a worker"""
+
+    def __init__(self, error: dict):
+        super().__init__(f"{error.get('name', 'Error')}: {error.get('message', '')}")
+        self.error = error
+
+
+class JsLimitError(JsError):
+    """The code made its worker run out of time or memory, the worker was restarted"""
+
+
+class JsWorkerError(Exception):
+    """The worker process died or stopped answering"""
+
+
+class JsWorker:
+    """
+    One long-lived Node process running js_worker.js with @near-lake/primitives loaded.
+    Requests are answered in order, so a worker is used by one caller at a time.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["node", f"--max-old-space-size={JS_WORKER_MAX_HEAP_MB}", JS_WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._ids = itertools.count()
+        self._responses = queue.Queue()
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    def _read_responses(self):
+        stdout = self.process.stdout
+        while True:
+            header = stdout.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            payload = stdout.read(FRAME_HEADER.unpack(header)[0])
+            self._responses.put(json.loads(payload))
+        self._responses.put(None)
+
+    def request(self, request: dict, raw_fields: dict = None, timeout: float = None) -> dict:
+        """
+        Sends the request and waits for its response. raw_fields maps field names to bytes that are
+        already JSON, like raw StreamerMessages, and are spliced into the request without being
+        decoded in Python.
+        """
+        profile = profiling.is_profiling()
+        request = {**request, "id": next(self._ids)}
+        if profile:
+            request["profile"] = True
+        started_at = time.perf_counter()
+        payload = json.dumps(request).encode("utf-8")
+        if raw_fields:
+            payload = b"".join(
+                [payload[:-1]]
+                + [
+                    b", " + json.dumps(name).encode("utf-8") + b": " + value
+                    for name, value in raw_fields.items()
+                ]
+                + [b"}"]
+            )
+        try:
+            self.process.stdin.write(FRAME_HEADER.pack(len(payload)) + payload)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise JsWorkerError(f"Javascript worker is not running: {e}")
+        try:
+            response = self._responses.get(timeout=timeout)
+        except queue.Empty:
+            self.close()
+            raise JsWorkerError(f"Javascript worker did not answer in {timeout} seconds")
+        if response is None:
+            raise JsWorkerError(
+                f"Javascript worker exited with code {self.process.wait()}"
+            )
+        if profile and "timings" in response:
+            timings = response["timings"]
+            profiling.add_stage_time("compile", timings["compile"] / 1000)
+            profiling.add_stage_time("parse_block", timings["parse"] / 1000)
+            profiling.add_stage_time("js_eval", timings["run"] / 1000)
+            # encoding, sending and decoding the request and the response
+            profiling.add_stage_time(
+                "transfer",
+                time.perf_counter() - started_at - sum(timings.values()) / 1000,
+            )
+        return response
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def ping(self, timeout: float = 5.0) -> bool:
+        try:
+            return self.request({"op": "ping"}, timeout=timeout).get("ok", False)
+        except JsWorkerError:
+            return False
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class JsWorkerPool:
+    """
+    Pool of Node workers that run extraction code in parallel. Workers that die are replaced
+    when they are returned to the pool, and idle workers are pinged by a background health check.
+    """
+
+    def __init__(self, size: int, health_check_seconds: float = JS_WORKER_HEALTH_CHECK_SECONDS):
+        self.size = size
+        self.restarts = 0
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(JsWorker())
+        if health_check_seconds > 0:
+            threading.Thread(
+                target=self._health_check_loop, args=(health_check_seconds,), daemon=True
+            ).start()
+
+    @contextmanager
+    def worker(self):
+        worker = self._idle.get()
+        if not worker.alive():
+            worker = self._restart(worker)
+        try:
+            yield worker
+        finally:
+            if not worker.alive():
+                worker = self._restart(worker)
+            self._idle.put(worker)
+
+    def _restart(self, worker: JsWorker) -> JsWorker:
+        worker.close()
+        self.restarts += 1
+        return JsWorker()
+
+    def check_health(self):
+        """Pings every idle worker once and replaces the ones that do not answer"""
+        for _ in range(self.size):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if not worker.ping():
+                worker = self._restart(worker)
+            self._idle.put(worker)
+
+    def _health_check_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.check_health()
+
+    def run_on_blocks(self, block_heights: [int], js: str, receiver: str = None) -> list:
+        """
+        Runs js on every block and returns the results in the order of block_heights, with a
+        JsError (or the error of loading the block) in place of failed ones.
+        The heights are split into consecutive batches, one per worker and at most
+        JS_BATCH_MAX_BLOCKS long, that run in parallel on the workers of the pool.
+        """
+        block_heights = list(block_heights)
+        batch_size = max(1, min(JS_BATCH_MAX_BLOCKS, -(-len(block_heights) // self.size)))
+        batches = [
+            block_heights[i : i + batch_size]
+            for i in range(0, len(block_heights), batch_size)
+        ]
+        if len(batches) <= 1:
+            return self._run_on_batch(block_heights, js, receiver)
+        with ThreadPoolExecutor(max_workers=min(self.size, len(batches))) as executor:
+            run_on_batch = profiling.bind(self._run_on_batch)
+            results = executor.map(lambda batch: run_on_batch(batch, js, receiver), batches)
+            return [result for batch_results in results for result in batch_results]
+
+    def _run_on_batch(self, block_heights: [int], js: str, receiver: str = None) -> list:
+        """
+        Runs js on the blocks in one worker call. Blocks the worker has not parsed yet are sent
+        in following calls of at most JS_BATCH_MAX_BYTES each, or one block when it is larger.
+        """
+        try:
+            with self.worker() as worker, _limit_errors():
+                return self._run_batch(worker, block_heights, js, receiver)
+        except JsLimitError as e:
+            return [e] * len(block_heights)
+
+    def _run_batch(self, worker: JsWorker, block_heights, js, receiver) -> list:
+        keys = [block_key(height, receiver) for height in block_heights]
+        request = {"op": "run_batch", **_js_fields(js)}
+        timeout = JS_EXECUTION_TIMEOUT_SECONDS * len(keys) + WATCHDOG_SLACK_SECONDS
+        response = worker.request(
+            {**request, "blocks": [{"key": k} for k in keys]}, timeout=timeout
+        )
+        if "error" in response:
+            # the code does not compile, so it fails the same way on every block
+            return [JsError(response["error"])] * len(block_heights)
+        results = [_batch_result(r) for r in response["results"]]
+
+        messages = {}
+        messages_bytes = 0
+        for i, result in enumerate(response["results"]):
+            if not result.get("missing_block"):
+                continue
+            try:
+                message = load_block_data(block_heights[i], receiver)
+            except Exception as e:
+                results[i] = e
+                continue
+            if messages and messages_bytes + len(message) > JS_BATCH_MAX_BYTES:
+                self._send_blocks(worker, request, keys, messages, results)
+                messages = {}
+                messages_bytes = 0
+            messages[i] = message
+            messages_bytes += len(message)
+        if messages:
+            self._send_blocks(worker, request, keys, messages, results)
+        return results
+
+    def _send_blocks(
+        self, worker: JsWorker, request: dict, keys: [str], messages: dict, results: list
+    ):
+        """Runs the request on the StreamerMessages by result index and stores their results"""
+        blocks = b",".join(
+            b'{"key": %s, "message": %s}' % (json.dumps(keys[i]).encode("utf-8"), message)
+            for i, message in messages.items()
+        )
+        timeout = JS_EXECUTION_TIMEOUT_SECONDS * len(messages) + WATCHDOG_SLACK_SECONDS
+        response = worker.request(request, {"blocks": b"[" + blocks + b"]"}, timeout)
+        for i, result in zip(messages, response["results"]):
+            results[i] = _batch_result(result)
+
+    def stats(self) -> dict:
+        """
+        Parsed block and compiled function counters summed over the workers, taken one idle
+        worker at a time
+        """
+        totals = dict.fromkeys(
+            ["hits", "misses", "entries", "bytes", "functions", "compiled"], 0
+        )
+        for _ in range(self.size):
+            with self.worker() as worker:
+                response = worker.request({"op": "stats"}, timeout=5.0)
+            for name in totals:
+                totals[name] += response[name]
+        return {**totals, "workers": self.size, "restarts": self.restarts}
+
+    def close(self):
+        for _ in range(self.size):
+            self._idle.get().close()
+
+
+@contextmanager
+def _limit_errors():
+    """
+    Reports a worker that stopped while running code as an error of the code. Workers found dead
+    while idle are replaced before they get a request, so the code is what killed or stalled it.
+    """
+    try:
+        yield
+    except JsWorkerError as e:
+        raise JsLimitError(
+            {
+                "name": "LimitError",
+                "message": f"{e}. The code has to finish within {JS_EXECUTION_TIMEOUT_SECONDS:g} "
+                f"seconds per block and {JS_WORKER_MAX_HEAP_MB} MB of memory",
+            }
+        )
+
+
+def block_key(block_height: int, receiver: str = None) -> str:
+    """Key of the block, or of its projection to the receiver, in worker and result caches"""
+    return str(block_height) if receiver is None else f"{block_height}:{receiver}"
+
+
+def normalize_js(js: str) -> str:
+    """
+    Strips the code and the ends of its lines, so that code differing only in that whitespace is
+    compiled once. Trailing spaces inside multiline template literals are not kept.
+    """
+    return "\n".join(line.rstrip() for line in js.strip().splitlines())
+
+
+def js_source_hash(js: str) -> str:
+    return hashlib.sha256(normalize_js(js).encode("utf-8")).hexdigest()
+
+
+def _js_fields(js: str) -> dict:
+    return {"js": normalize_js(js), "js_hash": js_source_hash(js)}
+
+
+def _js_error(error: dict) -> JsError:
+    if error.get("name") == "TimeoutError":
+        return JsLimitError(error)
+    return JsError(error)
+
+
+def _batch_result(result: dict):
+    if "error" in result:
+        return _js_error(result["error"])
+    return result.get("result")
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_js_worker_pool():
+    """Returns the shared worker pool, or None when JS_WORKER_POOL_SIZE is 0"""
+    global _pool
+    if JS_WORKER_POOL_SIZE <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = JsWorkerPool(JS_WORKER_POOL_SIZE)
+    return _pool
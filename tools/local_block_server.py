@@ -0,0 +1,98 @@
+"""
+Local stand-in for the block API, for offline runs, benchmarks and load tests.
+
+Serves GET /block/{height} with the same URL shape as the hosted endpoint, from a directory of
+{height}.json StreamerMessage fixtures or from a block cache directory (one with index.bin).
+Point the agent at it with BLOCK_SOURCE_URL=http://localhost:8081/block, or skip the server and
+read fixtures directly with BLOCK_SOURCE_URL=file:///path/to/fixtures.
+
+    python -m tools.local_block_server --dir fixtures --port 8081 --latency-ms 50
+"""
+
+import argparse
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from tools.block_store import BlockStore
+
+
+class BlockFixtures:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.block_store = None
+        if (self.path / "index.bin").exists():
+            self.block_store = BlockStore(self.path)
+
+    def get(self, height: int):
+        if self.block_store is not None:
+            return self.block_store.get(height)
+        try:
+            with open(self.path / f"{height}.json", "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def create_block_server(
+    fixtures_dir, host="127.0.0.1", port=8081, latency_ms=0.0, jitter_ms=0.0
+) -> ThreadingHTTPServer:
+    """
+    Creates a threaded HTTP server answering /block/{height} from fixtures_dir, every response
+    is delayed by latency_ms plus a uniformly random 0..jitter_ms. Call serve_forever() to run it.
+    """
+    fixtures = BlockFixtures(fixtures_dir)
+
+    class BlockRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.rstrip("/").split("/")
+            if len(parts) != 3 or parts[1] != "block" or not parts[2].isdigit():
+                self.send_error(400, "Expected /block/{height}")
+                return
+            delay_ms = latency_ms + random.uniform(0, jitter_ms)
+            if delay_ms > 0:
+                time.sleep(delay_ms / 1000)
+            data = fixtures.get(int(parts[2]))
+            if data is None:
+                self.send_error(404, f"Block {parts[2]} not found")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), BlockRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--dir", required=True, help="fixtures or block cache directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = create_block_server(
+        args.dir, args.host, args.port, args.latency_ms, args.jitter_ms
+    )
+    print(
+        f"Serving blocks from {args.dir} at http://{args.host}:{server.server_port}/block/{{height}}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
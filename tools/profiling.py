@@ -0,0 +1,126 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Time the stages of Javascript runs and schema inference, see profiled_call and stage
+JS_PROFILING = os.getenv("JS_PROFILING", "0").lower() in ("1", "true", "yes")
+# Number of recent call records kept for get_profile_records
+JS_PROFILE_RECORDS = int(os.getenv("JS_PROFILE_RECORDS", "100"))
+
+_current_record = contextvars.ContextVar("profile_record", default=None)
+_lock = threading.Lock()
+_records = deque(maxlen=JS_PROFILE_RECORDS)
+_summary = {}
+
+
+def enable_profiling(enabled: bool = True):
+    global JS_PROFILING
+    JS_PROFILING = enabled
+
+
+@contextmanager
+def profiled_call(name: str, **fields):
+    """
+    Collects the time of the stages run inside into one record of the call, like
+    {"call": name, **fields, "seconds": 1.2, "stages": {"fetch": {"count": 3, "seconds": 0.9}}},
+    which is added to the recent records and to the summary when the call ends.
+    Calls inside another profiled call belong to the outer one. Yields the record, or None when
+    profiling is off.
+    """
+    record = _current_record.get()
+    if not JS_PROFILING or record is not None:
+        yield record
+        return
+    record = {"call": name, **fields, "seconds": 0.0, "stages": {}}
+    token = _current_record.set(record)
+    started_at = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - started_at
+        _current_record.reset(token)
+        with _lock:
+            _records.append(record)
+            summary = _summary.setdefault(name, {"calls": 0, "seconds": 0.0, "stages": {}})
+            summary["calls"] += 1
+            summary["seconds"] += record["seconds"]
+            for stage_name, stage_time in record["stages"].items():
+                _add(summary["stages"], stage_name, stage_time["seconds"], stage_time["count"])
+
+
+@contextmanager
+def stage(name: str):
+    """Adds the time spent inside to the stage of the current profiled call, if any"""
+    if _current_record.get() is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - started_at)
+
+
+def is_profiling() -> bool:
+    """Whether the caller is inside a profiled call"""
+    return _current_record.get() is not None
+
+
+def add_stage_time(name: str, seconds: float, count: int = 1):
+    """Adds time measured elsewhere, like in a Javascript worker, to the current profiled call"""
+    record = _current_record.get()
+    if record is not None:
+        with _lock:
+            _add(record["stages"], name, seconds, count)
+
+
+def _add(stages: dict, name: str, seconds: float, count: int):
+    stage_time = stages.setdefault(name, {"count": 0, "seconds": 0.0})
+    stage_time["count"] += count
+    stage_time["seconds"] += seconds
+
+
+def bind(fn):
+    """Returns fn running in the profiled call of the caller, for running it in other threads"""
+    record = _current_record.get()
+    if record is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _current_record.set(record)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_record.reset(token)
+
+    return run
+
+
+def get_profile_records() -> [dict]:
+    """Records of the most recent profiled calls, oldest first"""
+    with _lock:
+        return [
+            {**record, "stages": {k: dict(v) for k, v in record["stages"].items()}}
+            for record in _records
+        ]
+
+
+def get_profile_summary() -> dict:
+    """Number of calls and time of every stage summed over all profiled calls, by call name"""
+    with _lock:
+        return {
+            name: {
+                **summary,
+                "stages": {k: dict(v) for k, v in summary["stages"].items()},
+            }
+            for name, summary in _summary.items()
+        }
+
+
+def reset_profile():
+    with _lock:
+        _records.clear()
+        _summary.clear()
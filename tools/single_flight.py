@@ -0,0 +1,73 @@
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time within the process. Callers that ask for a key
+    while its call is in flight wait for it and share its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+        if not leader:
+            return call.result()
+        try:
+            call.set_result(fn())
+        except BaseException as e:
+            call.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+
+_lock_fds = {}
+_lock_fds_lock = threading.Lock()
+
+
+def _lock_fd(path) -> int:
+    # POSIX record locks are dropped when the process closes any descriptor of the file,
+    # so every lock file is opened once and kept open for the life of the process
+    path = os.path.abspath(path)
+    with _lock_fds_lock:
+        fd = _lock_fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            _lock_fds[path] = fd
+        return fd
+
+
+@contextmanager
+def file_range_lock(path, offset: int = 0):
+    """
+    Exclusive lock on one byte of the file at offset, shared by all processes on the machine,
+    so a single lock file can hold a separate lock for every block height.
+    Record locks belong to the process, combine it with SingleFlight or a thread lock
+    to also exclude other threads. It is a no-op where fcntl is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = _lock_fd(path)
+    fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset)
+    try:
+        yield
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
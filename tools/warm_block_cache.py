@@ -0,0 +1,98 @@
+"""
+Warms up the block cache before a demo or a batch of generation jobs.
+
+Looks up the block heights of the receivers in the bitmap indexer over the last --days days and
+downloads every block that is not cached yet, reporting progress and throughput.
+
+    python -m tools.warm_block_cache social.near pool.near --days 7 --concurrency 32
+"""
+
+import argparse
+import threading
+import time
+
+from tools.bitmap_indexer_client import get_block_heights
+from tools.block_fetcher import BLOCK_PREFETCH_CONCURRENCY, prefetch_blocks
+from tools.block_store import get_block_store
+
+
+def warm_block_cache(
+    receivers: [str],
+    from_days_ago: int = 7,
+    limit: int = None,
+    max_in_flight: int = BLOCK_PREFETCH_CONCURRENCY,
+    report_every: float = 2.0,
+) -> dict:
+    """
+    Fetches the blocks of the receivers over the last from_days_ago days into the block cache.
+    :param receivers: receiver smart contracts for the exact match
+    :param from_days_ago: from how many days ago to start the search
+    :param limit: limit of block heights per receiver, default is all of them
+    :param max_in_flight: limit of concurrent downloads
+    :param report_every: seconds between progress lines
+    :return: summary with the number of heights, downloaded and failed blocks, bytes and seconds
+    """
+    block_heights = []
+    for receiver in receivers:
+        block_heights.extend(get_block_heights(receiver, from_days_ago, limit).tolist())
+    block_heights = list(dict.fromkeys(block_heights))
+    block_store = get_block_store()
+    cached = sum(1 for height in block_heights if height in block_store)
+    to_fetch = len(block_heights) - cached
+    print(
+        f"{len(block_heights)} block heights for {', '.join(receivers)}, {cached} already cached, fetching {to_fetch}"
+    )
+
+    lock = threading.Lock()
+    progress = {"done": 0, "failed": 0, "bytes": 0}
+    started_at = time.monotonic()
+    last_report = [started_at]
+
+    def report():
+        elapsed = max(time.monotonic() - started_at, 1e-9)
+        print(
+            f"[{progress['done']}/{to_fetch}] {progress['done'] / elapsed:.1f} blocks/s, "
+            f"{progress['bytes'] / elapsed / 1024 / 1024:.2f} MiB/s, {progress['failed']} failed"
+        )
+
+    def on_fetched(height, error):
+        with lock:
+            progress["done"] += 1
+            if error is not None:
+                progress["failed"] += 1
+            else:
+                location = block_store.locate(height)
+                progress["bytes"] += location[2] if location else 0
+            now = time.monotonic()
+            if now - last_report[0] >= report_every:
+                last_report[0] = now
+                report()
+
+    prefetch_blocks(block_heights, max_in_flight, on_fetched)
+    report()
+    return {
+        "block_heights": len(block_heights),
+        "cached": cached,
+        "fetched": progress["done"] - progress["failed"],
+        "failed": progress["failed"],
+        "bytes": progress["bytes"],
+        "seconds": time.monotonic() - started_at,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("receivers", nargs="+", help="receiver smart contracts")
+    parser.add_argument("--days", type=int, default=7, help="from how many days ago")
+    parser.add_argument(
+        "--limit", type=int, default=None, help="limit of block heights per receiver"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=BLOCK_PREFETCH_CONCURRENCY
+    )
+    args = parser.parse_args()
+    warm_block_cache(args.receivers, args.days, args.limit, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()